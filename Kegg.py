@@ -1,10 +1,40 @@
+import numpy as np
 import pandas as pd
 from utils import KeggApi, multiprocess_task
 from definitions import *
 from os.path import join as pjoin
-from utils import save_obj, load_obj, read_in_chunks
+from utils import save_obj, load_obj, save_obj_sections, load_obj_section, atomic_write
 import os
 from functools import partial
+from metrics import METRICS
+
+
+def _snv_tables():
+    """
+    lookup tables of all single nucleotide changes of the 64 codons, slot = 3 * codon_position + alt_number
+    :return: tuple of numpy arrays (ref_aa [64], alt_na [64, 9], alt_aa [64, 9], nonsynonymous [64, 9])
+    """
+    n_slots = CODON_LENGTH * len(NA_CHANGE['a'])
+    ref_aa = np.empty(len(CODON_TRANSLATOR), dtype='S1')
+    alt_na, alt_aa = np.empty((len(CODON_TRANSLATOR), n_slots), dtype='S1'), np.empty((len(CODON_TRANSLATOR), n_slots), dtype='S1')
+    nonsynonymous = np.zeros((len(CODON_TRANSLATOR), n_slots), dtype=bool)
+    for codon, aa in CODON_TRANSLATOR.items():
+        codon_idx = sum(NA_ORDER.index(na) * 4 ** (CODON_LENGTH - 1 - i) for i, na in enumerate(codon))
+        ref_aa[codon_idx] = aa
+        for idx, ref_na in enumerate(codon):
+            for alt_idx, alt in enumerate(NA_CHANGE[ref_na]):
+                slot = (CODON_LENGTH * idx) + alt_idx
+                alt_aa_ = CODON_TRANSLATOR[codon[:idx] + alt + codon[idx + 1:]]
+                alt_na[codon_idx, slot], alt_aa[codon_idx, slot] = alt, alt_aa_
+                nonsynonymous[codon_idx, slot] = alt_aa_ != aa  # synonym variants are ignored
+    return ref_aa, alt_na, alt_aa, nonsynonymous
+
+
+SNV_REF_AA, SNV_ALT_NA, SNV_ALT_AA, SNV_NONSYNONYMOUS = _snv_tables()
+NA_CODES = np.full(256, -1, dtype=np.int16)
+NA_CODES[np.frombuffer(NA_ORDER.encode(), dtype=np.uint8)] = np.arange(len(NA_ORDER))
+AA_CODES = np.full(256, -1, dtype=np.int16)
+AA_CODES[np.frombuffer(ESM_AA_ORDER.encode(), dtype=np.uint8)] = np.arange(len(ESM_AA_ORDER))
 
 
 class KeggNetwork:
@@ -24,7 +54,7 @@ class KeggNetwork:
 
     def _create_new_instance(self, kegg_id, network_type):
         assert network_type.lower() in NETWORK_TYPES, NETWORK_TYPE_ERROR
-        kegg_api = KeggApi()
+        kegg_api = KeggApi(pool_size=KEG_API_RECOMMENDED_WORKERS)
         self.id, self.type = kegg_id, network_type.lower()
         self.gene_list = kegg_api.get_gene_list(kegg_id)
         gene_objects = []
@@ -33,7 +63,8 @@ class KeggNetwork:
         callback = partial(_callback, gene_objects)
         tasks = [{gene_id} for gene_id in self.gene_list]  # tasks must be iterable of iterables
         #  too many workers may overload Kegg servers
-        multiprocess_task(tasks=tasks, target=lambda gene_id: KeggGene(gene_id), callback=callback, workers=6)
+        multiprocess_task(tasks=tasks, target=lambda gene_id: KeggGene(gene_id), callback=callback,
+                          workers=KEG_API_RECOMMENDED_WORKERS)
         for gene in gene_objects:
             self._len['aa'] += gene.length('aa')
             self._len['na'] += gene.length('na')
@@ -48,59 +79,226 @@ class KeggNetwork:
         for gene in self.gene_list:
             yield KeggGene(gene)
 
-    def all_snvs(self, outpath='', index=True):
+    def metadata(self):
+        """
+        metadata of all network genes, sequences are not loaded
+        :return: pandas DataFrame with columns GENE_TABLE_COLUMNS
+        """
+        return KeggGene.metadata_table(self.gene_list)
+
+    def snv_blocks(self):
+        """
+        SNVs of every network gene, genes missing from the SNV cache are cached
+        :return: tuple (list of KeggGene, list of SNV blocks) see KeggGene.snv_block
+        """
+        genes = list(self.genes)
+        tasks = [{gene} for gene in genes]
+        target = lambda gene: gene.snv_block()
+        blocks = []
+        multiprocess_task(tasks=tasks, target=target, callback=blocks.append)
+        return genes, blocks
+
+    def all_snvs(self, outpath='', index=True, to_csv=True):
         """
         creates a DataFrame of all single nucleotide variants in the path
+        variants are assembled from the cached SNVs of each gene, see KeggGene.snv_block
         :param index: bool include index in DataFrame
         :param outpath: if not given will be saved to default path at KEGG_PATHWAY_MUTATIONS_PATH
+        :param to_csv: bool if false DataFrame is not saved
         :return: pandas DataFrame
         """
-
-        tasks = [{gene} for gene in self.genes]
-        target = lambda gene: gene.all_snvs()
-        collector = []
-        def callback_(array, data):
-            #print(f"called! {len(array)}")
-            array.append(data)
-        callback = partial(callback_, collector)
-        multiprocess_task(tasks=tasks, target=target, callback=callback)
-        all_snvs = pd.concat(collector)
+        genes, blocks = self.snv_blocks()
+        snvs = np.concatenate(blocks) if blocks else np.empty(0, dtype=SNV_DTYPE)
+        proteins = np.repeat(np.array([gene.uid for gene in genes], dtype=object), [len(block) for block in blocks])
+        all_snvs = KeggGene.snv_block_to_df(snvs, proteins)
+        if not to_csv:
+            return all_snvs
         if not outpath:
             outpath = pjoin(KEGG_PATHWAY_MUTATIONS_PATH, f"{self.id}.csv")
-        all_snvs.to_csv(outpath, index=index)
+        with atomic_write(outpath, 'w') as file:
+            all_snvs.to_csv(file, index=index)
         return all_snvs
 
 
 class KeggGene:
     """Gene instance for KEGG pathway"""
 
-    def __init__(self, kegg_id, default_init=True):
-        """Constructor for Protein"""
+    #  metadata and sequences are pickled as separate sections, sequences are only loaded when first accessed
+    __slots__ = GENE_METADATA + ('_len', '_aa_seq', '_na_seq', '_seq_offset', '_dir_name', '_directory')
+
+    def __init__(self, kegg_id, default_init=True, load=True):
+        """
+        Constructor for Protein
+        :param default_init: bool if true genes missing from DB are fetched from KEGG
+        :param load: bool if false the object in DB is not loaded, e.g. when it is about to be overwritten
+        """
         self.kegg_id, self.uniprot_id, self.ref_names = kegg_id, None, None
-        self.na_seq, self.aa_seq, self.chr, self.start, self.end = None, None, None, None, None
-        self.coding_type = None
-        self._dir_name = kegg_id.replace(':', '_')
-        self._directory = pjoin(KEGG_GENES_PATH, self._dir_name + '.pickle')
-        if os.path.exists(self._directory):
-            load_obj(self, self._directory, name=kegg_id)
+        self.chr, self.start, self.end, self.coding_type = None, None, None, None
+        self._aa_seq, self._na_seq, self._seq_offset = None, None, None
+        self._len = {'aa': 0, 'na': 0}
+        self._set_directory()
+        if load and os.path.exists(self._directory):
+            self._load()
         elif default_init:
             self._create_new_instance(kegg_id)
 
     def __len__(self):
-        return len(self.aa_seq)
+        return self.length('aa')
+
+    @staticmethod
+    def gene_path(kegg_id):
+        """
+        :param kegg_id: str kegg gene id
+        :return: str path of the gene object in DB
+        """
+        return pjoin(KEGG_GENES_PATH, kegg_id.replace(':', '_') + '.pickle')
+
+    @staticmethod
+    def cache_path(kegg_id, directory):
+        """
+        :param kegg_id: str kegg gene id
+        :param directory: str one of KEGG_GENE_SNVS_PATH | KEGG_GENE_EMBEDDINGS_PATH | KEGG_GENE_SCORES_PATH
+        :return: str path of the gene numpy cache in directory
+        """
+        return pjoin(directory, kegg_id.replace(':', '_') + '.npy')
+
+    def _set_directory(self):
+        self._dir_name = self.kegg_id.replace(':', '_')
+        self._directory = self.gene_path(self.kegg_id)
+
+    @staticmethod
+    def _read_metadata(path, name=''):
+        """
+        :param path: str path of gene object
+        :param name: str gene name for error message
+        :return: tuple (metadata dict, offset of sequences section)
+        offset is None for objects saved before metadata and sequences were split, their metadata holds the sequences
+        """
+        metadata, offset = load_obj_section(path, name=name)
+        if 'aa_seq' in metadata:
+            metadata['aa_len'] = len(metadata['aa_seq']) if metadata['aa_seq'] else 0
+            metadata['na_len'] = len(metadata['na_seq']) if metadata['na_seq'] else 0
+            return metadata, None
+        return metadata, offset
+
+    @staticmethod
+    def sequence_table(gene_ids):
+        """
+        reference sequences of many genes by gene symbol, used to validate cBio protein changes
+        :param gene_ids: iterable of kegg gene ids, genes missing from DB are skipped
+        :return: pandas DataFrame indexed by symbol with columns aa_seq, na_seq
+        """
+        metadata = KeggGene.metadata_table(gene_ids)
+        symbols, aa_seqs, na_seqs = [], [], []
+        for kegg_id, ref_names in zip(metadata['kegg_id'], metadata['ref_names']):
+            if not ref_names:
+                continue
+            gene = KeggGene(kegg_id)
+            symbols.append(ref_names[0].rstrip(','))
+            aa_seqs.append(gene.aa_seq)
+            na_seqs.append(gene.na_seq)
+        table = pd.DataFrame({'aa_seq': aa_seqs, 'na_seq': na_seqs}, index=pd.Index(symbols, name='symbol'))
+        return table[~table.index.duplicated(keep='first')]
+
+    def _set_metadata(self, metadata):
+        for field in GENE_METADATA:
+            setattr(self, field, metadata.get(field))
+        self._len = {'aa': metadata.get('aa_len', 0), 'na': metadata.get('na_len', 0)}
+
+    def _load(self):
+        metadata, offset = self._read_metadata(self._directory, name=self.kegg_id)
+        self._set_metadata(metadata)
+        if offset is not None:
+            self._seq_offset = offset
+            return
+        #  migrate old objects so metadata can be loaded without the sequences next time
+        self.aa_seq, self.na_seq = metadata['aa_seq'], metadata['na_seq']
+        self._save()
+
+    def _load_sequences(self):
+        if self._seq_offset is None:
+            return
+        sequences, _ = load_obj_section(self._directory, offset=self._seq_offset, name=self.kegg_id)
+        self._aa_seq, self._na_seq = (sequences[field] for field in GENE_SEQUENCES)
+        self._seq_offset = None
+
+    def _save(self):
+        metadata = {field: getattr(self, field) for field in GENE_METADATA}
+        metadata['aa_len'], metadata['na_len'] = self._len['aa'], self._len['na']
+        sequences = {field: getattr(self, field) for field in GENE_SEQUENCES}
+        save_obj_sections(self._directory, metadata, sequences)
+
+    def _clear_caches(self):
+        """
+        removes SNVs, ESM probabilities and scores derived from the previous sequences of the gene
+        """
+        for directory in GENE_CACHE_PATHS:
+            path = self.cache_path(self.kegg_id, directory)
+            if os.path.exists(path):
+                os.remove(path)
 
     def _create_new_instance(self, kegg_id):
         kegg_api = KeggApi()
         self.uniprot_id = kegg_api.convert_gene_names(kegg_id)  # list
         self.aa_seq = kegg_api.gene_seq(kegg_id, 'aaseq')[kegg_id]
         self.na_seq = kegg_api.gene_seq(kegg_id, 'ntseq')[kegg_id]
-        save_obj(self, self._directory)
+        self._clear_caches()
+        self._save()
 
     def create_from_dict(self, data):
-        self.__dict__ = data
-        self._dir_name = self.kegg_id.replace(':', '_')
-        self._directory = pjoin(KEGG_GENES_PATH, self._dir_name + '.pickle')
-        save_obj(self, self._directory)
+        self._set_metadata(data)
+        self._seq_offset = None
+        self.aa_seq, self.na_seq = data['aa_seq'], data['na_seq']
+        self._set_directory()
+        self._clear_caches()
+        self._save()
+
+    @property
+    def aa_seq(self):
+        """
+        amino acid sequence, loaded from DB on first access
+        :return: str
+        """
+        self._load_sequences()
+        return self._aa_seq
+
+    @aa_seq.setter
+    def aa_seq(self, seq):
+        self._load_sequences()
+        self._aa_seq = seq
+        self._len['aa'] = len(seq) if seq else 0
+
+    @property
+    def na_seq(self):
+        """
+        nucleic acid sequence, loaded from DB on first access
+        :return: str
+        """
+        self._load_sequences()
+        return self._na_seq
+
+    @na_seq.setter
+    def na_seq(self, seq):
+        self._load_sequences()
+        self._na_seq = seq
+        self._len['na'] = len(seq) if seq else 0
+
+    @staticmethod
+    def metadata_table(gene_ids):
+        """
+        loads metadata of many genes without unpickling their sequences
+        :param gene_ids: iterable of kegg gene ids, genes missing from DB are skipped
+        :return: pandas DataFrame with columns GENE_TABLE_COLUMNS
+        """
+        table = {column: [] for column in GENE_TABLE_COLUMNS}
+        for kegg_id in gene_ids:
+            path = KeggGene.gene_path(kegg_id)
+            if not os.path.exists(path):
+                continue
+            metadata, _ = KeggGene._read_metadata(path, name=kegg_id)
+            for column in GENE_TABLE_COLUMNS:
+                table[column].append(metadata.get(column))
+        return pd.DataFrame(table, columns=GENE_TABLE_COLUMNS)
 
     @property
     def uid(self):
@@ -108,7 +306,9 @@ class KeggGene:
         primary uniprot id
         :return: str
         """
-        return self.uniprot_id['primary']
+        if isinstance(self.uniprot_id, dict):
+            return self.uniprot_id['primary']
+        return self.uniprot_id  # genes created from KEGG gene info hold a single id
 
     @property
     def alias_uid(self):
@@ -116,48 +316,105 @@ class KeggGene:
         alias uniprot ids does not return the main id
         :return: set
         """
-        return self.uniprot_id['secondary']
+        if isinstance(self.uniprot_id, dict):
+            return self.uniprot_id['secondary']
+        return set()
 
     def length(self, seq='aa'):
         """
         :param seq: aa | na
         :return: return length of amino acid or nucleic acid sequence
         """
-        return len(self.aa_seq) if seq == 'aa' else len(self.na_seq)
+        return self._len['aa'] if seq == 'aa' else self._len['na']
+
+    def snv_block(self, recalc=False):
+        """
+        all single nucleotide variants in the gene in compact form, cached in KEGG_GENE_SNVS_PATH
+        :param recalc: bool if true cached variants are ignored and recreated
+        :return: numpy structured array of SNV_DTYPE, memory-mapped when loaded from cache
+        """
+        path = self.cache_path(self.kegg_id, KEGG_GENE_SNVS_PATH)
+        if os.path.exists(path) and not recalc:
+            return np.load(path, mmap_mode='r')
+        with METRICS.timer('stage_seconds', stage='snv_generation'):
+            na_seq = self.na_seq[:-CODON_LENGTH].lower().encode()  # ignore stop codon
+            n_codons = len(na_seq) // CODON_LENGTH
+            raw = np.frombuffer(na_seq, dtype='S1', count=n_codons * CODON_LENGTH)
+            codons = NA_CODES[raw.view(np.uint8)].reshape(n_codons, CODON_LENGTH)
+            #  codons with unknown nucleotides are skipped
+            valid = (codons >= 0).all(axis=1)
+            codon_idx = np.where(valid, codons[:, 0] * 16 + codons[:, 1] * 4 + codons[:, 2], 0)
+            codon_no, slot = np.nonzero(SNV_NONSYNONYMOUS[codon_idx] & valid[:, None])
+            block = np.empty(len(codon_no), dtype=SNV_DTYPE)
+            block['pos'] = (CODON_LENGTH * codon_no) + (slot // len(NA_CHANGE['a']))
+            block['ref'] = raw[block['pos']]
+            block['alt'] = SNV_ALT_NA[codon_idx[codon_no], slot]
+            block['ref_aa'] = SNV_REF_AA[codon_idx[codon_no]]
+            block['alt_aa'] = SNV_ALT_AA[codon_idx[codon_no], slot]
+        with atomic_write(path) as file:
+            np.save(file, block)
+        return block
+
+    def esm_probabilities(self, embedder=None, recalc=False):
+        """
+        ESM mutation probabilities of the protein, cached in KEGG_GENE_EMBEDDINGS_PATH
+        :param embedder: ESMEmbedding required only if probabilities are not cached
+        :param recalc: bool if true cached probabilities are recreated
+        :return: numpy array [L, 20] columns ordered by ESM_AA_ORDER
+        """
+        path = self.cache_path(self.kegg_id, KEGG_GENE_EMBEDDINGS_PATH)
+        if os.path.exists(path) and not recalc:
+            return np.load(path, mmap_mode='r')
+        probs = embedder.protein_probabilities(self.kegg_id, self.aa_seq)
+        with atomic_write(path) as file:
+            np.save(file, probs)
+        return probs
+
+    def snv_scores(self, embedder=None, recalc=False):
+        """
+        scores every variant of snv_block as log p(alt) - log p(ref) of the ESM probabilities
+        cached in KEGG_GENE_SCORES_PATH, nonsense variants are scored NaN
+        :param embedder: ESMEmbedding required only if probabilities are not cached
+        :param recalc: bool if true cached scores are recreated
+        :return: numpy float32 array aligned with snv_block
+        """
+        path = self.cache_path(self.kegg_id, KEGG_GENE_SCORES_PATH)
+        if os.path.exists(path) and not recalc:
+            return np.load(path, mmap_mode='r')
+        block, probs = self.snv_block(), self.esm_probabilities(embedder)
+        aa_pos = (block['pos'] // CODON_LENGTH).astype(np.int64)
+        ref_col, alt_col = AA_CODES[block['ref_aa'].view(np.uint8)], AA_CODES[block['alt_aa'].view(np.uint8)]
+        valid = (aa_pos < len(probs)) & (ref_col >= 0) & (alt_col >= 0)
+        log_probs = np.log(probs)
+        scores = np.full(len(block), np.nan, dtype=np.float32)
+        scores[valid] = log_probs[aa_pos[valid], alt_col[valid]] - log_probs[aa_pos[valid], ref_col[valid]]
+        with atomic_write(path) as file:
+            np.save(file, scores)
+        return scores
 
-    def all_snvs(self, outpath='', index=False):
+    @staticmethod
+    def snv_block_to_df(block, protein):
+        """
+        :param block: numpy structured array of SNV_DTYPE
+        :param protein: str or array of protein ids one per variant
+        :return: pandas DataFrame with FAMANALYSIS_COLUMNS
+        """
+        pos = pd.Series(block['pos'], dtype='int64')
+        ref_aa, alt_aa = pd.Series(block['ref_aa'].astype('U1')), pd.Series(block['alt_aa'].astype('U1'))
+        values = ['-', pos, pos, block['ref'].astype('U1'), block['alt'].astype('U1'), protein,
+                  ref_aa + pos.astype(str) + alt_aa]
+        return pd.DataFrame(dict(zip(FAMANALYSIS_COLUMNS, values)), columns=FAMANALYSIS_COLUMNS)
+
+    def all_snvs(self, outpath='', index=False, recalc=False):
         """
         creates a DataFrame all single nucleotide variants in the gene
         :param index: bool inckude index column in DataFrame
         :param outpath: if given will save the DataFrane in csv format
+        :param recalc: bool if true cached variants are recreated
         :return: pandas DataFrame
         """
-        row_data = lambda index, ref_na, alt_na, ref_aa, alt_aa : \
-            ['-', index, index, ref_na, alt_na, self.uid, f'{ref_aa}{index}{alt_aa}']
-        mutate_codon = lambda codon, idx, alt: codon[:idx] + alt + codon[idx + 1:]
-        df = pd.DataFrame(columns=FAMANALYSIS_COLUMNS)
-        for chunk, codon in enumerate(read_in_chunks(self.na_seq[:-3], chunk_size=CODON_LENGTH)):  # ignore stop codon
-            ref_aa = CODON_TRANSLATOR[codon]
-            for idx, ref_na in enumerate(codon):
-                index = (CODON_LENGTH * chunk) + idx
-                for alt_na in NA_CHANGE[ref_na]:
-                    alt_codon = mutate_codon(codon, idx, alt_na)
-                    alt_aa = CODON_TRANSLATOR[alt_codon]
-                    if  alt_aa == ref_aa:  # ignore nonsense and synonym variants
-                        continue
-                    df.loc[len(df)] = row_data(index, ref_na, alt_na, ref_aa, alt_aa)
+        df = self.snv_block_to_df(self.snv_block(recalc=recalc), self.uid)
         if outpath:
-            df.to_csv(outpath, index=index)
+            with atomic_write(outpath, 'w') as file:
+                df.to_csv(file, index=index)
         return df
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,151 @@
+import argparse
+import gzip
+import os
+import random
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+
+class KeggStandIn:
+    """
+    local HTTP stand-in for the KEGG REST api serving list, link, conv and get responses
+
+    responses come from a SyntheticGenome, files in recordings_dir override them.
+    a recording is named after the request path with '/' replaced by '_', e.g. get_hsa:1000_aaseq
+
+    Usage example:
+        with KeggStandIn(SyntheticGenome(), latency=0.01) as server:
+            os.environ['KEGG_API_URL'] = server.url
+    """
+
+    def __init__(self, genome, latency=0.0, error_rate=0.0, retry_after=None, recordings_dir=None, seed=0,
+                 compress=True):
+        """
+        :param genome: SyntheticGenome, may be set after the server started to learn its url first
+        :param latency: float seconds added to every response
+        :param error_rate: float probability of answering 429 Too Many Requests
+        :param retry_after: optional int Retry-After header sent with 429 responses
+        :param recordings_dir: optional str directory of recorded responses
+        :param seed: int random seed for errors
+        :param compress: bool gzip responses of clients accepting it
+        """
+        self.genome, self.latency, self.error_rate, self.retry_after = genome, latency, error_rate, retry_after
+        self.recordings_dir, self.compress = recordings_dir, compress
+        self.requests, self.throttled, self.connections, self.bytes_sent = 0, 0, 0, 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def _recorded(self, path):
+        if not self.recordings_dir:
+            return None
+        recording = os.path.join(self.recordings_dir, path.strip('/').replace('/', '_'))
+        if os.path.exists(recording):
+            with open(recording, 'r') as file:
+                return file.read()
+        return None
+
+    def respond(self, path):
+        """
+        :param path: str request path e.g. /get/hsa:1000+hsa:1001/aaseq
+        :return: tuple (status code, body)
+        """
+        recorded = self._recorded(path)
+        if recorded is not None:
+            return 200, recorded
+        parts = unquote(path).strip('/').split('/')
+        command, params = parts[0], parts[1:] + ['', '']
+        if command == 'list' and params[0] == 'pathway':
+            return 200, self.genome.pathway_list()
+        if command == 'list':
+            return 200, self.genome.gene_list()
+        if command == 'link':
+            return 200, self.genome.pathway_link(params[1])
+        if command == 'conv':
+            return 200, self.genome.conv_uniprot(params[1].split('+'))
+        if command == 'get' and params[1] in ('aaseq', 'ntseq'):
+            return 200, self.genome.fasta(params[0].split('+'), params[1])
+        if command == 'get':
+            return 200, self.genome.flat_file(params[0].split('+'))
+        return 400, ''
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep connections alive
+
+            def setup(self):
+                super().setup()
+                #  headers and body are written separately, avoid Nagle delays on kept alive connections
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with stand_in._lock:
+                    stand_in.connections += 1
+
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.requests += 1
+                    throttle = stand_in._rng.random() < stand_in.error_rate
+                    stand_in.throttled += throttle
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                status, body = (429, '') if throttle else stand_in.respond(self.path)
+                body = body.encode()
+                compressed = stand_in.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compressed:
+                    body = gzip.compress(body)
+                with stand_in._lock:
+                    stand_in.bytes_sent += len(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                if throttle and stand_in.retry_after is not None:
+                    self.send_header('Retry-After', str(stand_in.retry_after))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    from benchmarks.synthetic import SyntheticGenome
+    parser = argparse.ArgumentParser(description='local KEGG stand-in server')
+    parser.add_argument('--genes', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--recordings', help='directory of recorded responses')
+    args = parser.parse_args()
+    with KeggStandIn(SyntheticGenome(args.genes), latency=args.latency, error_rate=args.error_rate,
+                     recordings_dir=args.recordings) as server:
+        print(f'serving KEGG stand-in at {server.url}, set KEGG_API_URL={server.url}')
+        threading.Event().wait()
@@ -0,0 +1,213 @@
+"""
+offline benchmarks of the project hot paths, KEGG requests are served by a local stand-in
+
+Usage example (from the repository root):
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --output new.json --compare bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REGRESSION_THRESHOLD = 1.1  # new / old median above this is reported as a regression
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_db(dirs):
+    for directory in dirs:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+
+def measure(name, run, server, setup=None, repeat=3, size=None):
+    """
+    :param name: str benchmark name
+    :param run: callable timed part
+    :param server: KeggStandIn, requests and connections it served are counted per repetition
+    :param setup: optional callable run untimed before every repetition
+    :param repeat: int repetitions
+    :param size: optional int number of items processed per repetition
+    :return: dict benchmark result
+    """
+    seconds = []
+    requests, throttled, connections = server.requests, server.throttled, server.connections
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+    print(f'{name:<32} median {statistics.median(seconds):.4f}s  min {min(seconds):.4f}s', file=sys.stderr)
+    return {'name': name, 'size': size, 'repeat': repeat, 'seconds': seconds,
+            'median': statistics.median(seconds), 'mean': statistics.mean(seconds), 'min': min(seconds),
+            'kegg_requests': (server.requests - requests) / repeat,
+            'kegg_throttled': (server.throttled - throttled) / repeat,
+            'kegg_connections': (server.connections - connections) / repeat}
+
+
+def benchmarks(genome, server, args):
+    """
+    :param genome: SyntheticGenome served by server
+    :param server: KeggStandIn
+    :param args: parsed command line arguments
+    :return: list of benchmark results
+    """
+    from definitions import DIRS_TO_CREATE, KEGG_GENES_PATH, KEGG_GENE_SNVS_PATH, JOURNALS_PATH, \
+        KEGG_PATHWAY_OBJECTS_PATH
+    from utils import KeggApi, CbioApi, ESMEmbedding
+    from Kegg import KeggGene, KeggNetwork
+    from main import init_kegg_genome
+    gene_ids = list(genome.genes)
+    selected = lambda name: not args.only or name in args.only
+    results = []
+
+    reset_db(DIRS_TO_CREATE)
+    if selected('init_kegg_genome'):
+        results.append(measure('init_kegg_genome', init_kegg_genome, server, repeat=args.repeat,
+                               size=len(gene_ids), setup=lambda: reset_db([KEGG_GENES_PATH, JOURNALS_PATH])))
+    else:
+        init_kegg_genome()
+
+    if selected('process_genes_info'):
+        raw = genome.flat_file(gene_ids)
+        results.append(measure('process_genes_info', lambda: KeggApi()._process_genes_info(raw), server,
+                               repeat=args.repeat, size=len(gene_ids)))
+
+    if selected('gene_all_snvs'):
+        genes = [KeggGene(kegg_id) for kegg_id in gene_ids]
+        results.append(measure('gene_all_snvs', lambda: [gene.all_snvs(recalc=True) for gene in genes], server,
+                               repeat=args.repeat, size=len(genes)))
+
+    pathway_id = next(iter(genome.pathways))
+    if selected('network_create'):
+        results.append(measure('network_create', lambda: KeggNetwork(pathway_id, 'pathway'), server,
+                               repeat=args.repeat, setup=lambda: reset_db([KEGG_PATHWAY_OBJECTS_PATH])))
+
+    if selected('network_all_snvs') or selected('network_all_snvs_cached'):
+        network = KeggNetwork(pathway_id, 'pathway')
+        size = len(network.gene_list)
+        if selected('network_all_snvs'):
+            results.append(measure('network_all_snvs', network.all_snvs, server, repeat=args.repeat, size=size,
+                                   setup=lambda: reset_db([KEGG_GENE_SNVS_PATH])))
+        if selected('network_all_snvs_cached'):
+            network.all_snvs()
+            results.append(measure('network_all_snvs_cached', network.all_snvs, server, repeat=args.repeat,
+                                   size=size))
+
+    if selected('study_to_csv') or selected('study_to_csv_validated'):
+        mutations = genome.mutations(args.mutations)
+        outpath = os.path.join(tempfile.gettempdir(), 'benchmark_study.csv')
+        if selected('study_to_csv'):
+            results.append(measure('study_to_csv', lambda: CbioApi.study_to_csv(mutations, outpath=outpath),
+                                   server, repeat=args.repeat, size=len(mutations)))
+        if selected('study_to_csv_validated'):
+            sequences = KeggGene.sequence_table(gene_ids)
+            run = lambda: CbioApi.study_to_csv(mutations, outpath=outpath, sequences=sequences)
+            results.append(measure('study_to_csv_validated', run, server, repeat=args.repeat, size=len(mutations)))
+
+    if selected('esm_tiny'):
+        import esm
+        alphabet = esm.Alphabet.from_architecture('ESM-1b')
+        model = esm.ESM2(num_layers=2, embed_dim=64, attention_heads=4, alphabet=alphabet)
+        embedder = ESMEmbedding(model=model.eval(), alphabet=alphabet)
+        sequences = [genome.genes[kegg_id].aa_seq for kegg_id in gene_ids[:args.esm_proteins]]
+        run = lambda: [embedder.protein_probabilities(str(i), seq) for i, seq in enumerate(sequences)]
+        results.append(measure('esm_tiny', run, server, repeat=args.repeat, size=len(sequences)))
+
+    return results
+
+
+def compare(results, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """
+    prints new / old median ratio of every benchmark present in both runs
+    :return: list of names of regressed benchmarks
+    """
+    with open(baseline_path, 'r') as file:
+        baseline = {result['name']: result for result in json.load(file)['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get(result['name'])
+        if old is None:
+            continue
+        ratio = result['median'] / old['median'] if old['median'] else float('inf')
+        flag = 'REGRESSION' if ratio > threshold else ''
+        if flag:
+            regressions.append(result['name'])
+        print(f'{result["name"]:<32} {old["median"]:.4f}s -> {result["median"]:.4f}s  x{ratio:.2f} {flag}',
+              file=sys.stderr)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PathwayAtlas offline benchmarks')
+    parser.add_argument('--genes', type=int, default=200, help='synthetic genome size')
+    parser.add_argument('--pathways', type=int, default=5)
+    parser.add_argument('--pathway-size', type=int, default=40)
+    parser.add_argument('--mutations', type=int, default=200000, help='synthetic cBio study size')
+    parser.add_argument('--esm-proteins', type=int, default=5, help='proteins embedded by the tiny ESM model')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every KEGG response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 429 response')
+    parser.add_argument('--retry-after', type=int, help='Retry-After header of 429 responses')
+    parser.add_argument('--recordings', help='directory of recorded KEGG responses')
+    parser.add_argument('--only', nargs='+', help='run only these benchmarks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='json output path, printed to stdout if not given')
+    parser.add_argument('--compare', help='json output of a previous run')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    #  repository modules read data paths relative to the working directory
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    from benchmarks.kegg_server import KeggStandIn
+    workdir = tempfile.mkdtemp(prefix='pathway_atlas_bench_')
+    with KeggStandIn(None, latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after,
+                     recordings_dir=args.recordings, seed=args.seed) as server:
+        #  KEGG_API_URL is read once when definitions is first imported
+        os.environ['KEGG_API_URL'] = server.url
+        from benchmarks.synthetic import SyntheticGenome
+        import utils  # loads the cBio cancer types before leaving the repository
+        genome = SyntheticGenome(args.genes, n_pathways=args.pathways, pathway_size=args.pathway_size,
+                                 seed=args.seed)
+        server.genome = genome
+        os.chdir(workdir)
+        try:
+            results = benchmarks(genome, server, args)
+        finally:
+            os.chdir(REPO)
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {'commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'config': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import random
+from types import SimpleNamespace
+from definitions import CODON_TRANSLATOR, STOP_AA
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+STOP_CODON = 'tag'
+#  human protein lengths are roughly log-normal with a median of ~400 residues
+LENGTH_MEDIAN = 400
+LENGTH_SIGMA = 0.7
+MIN_LENGTH, MAX_LENGTH = 50, 5000
+LINE_WIDTH = 60
+GENE_ID_OFFSET = 1000
+
+
+def _sense_codons():
+    codons = {}
+    for codon, aa in CODON_TRANSLATOR.items():
+        if aa != STOP_AA:
+            codons.setdefault(aa, []).append(codon)
+    return codons
+
+
+class SyntheticGenome:
+    """
+    synthetic KEGG genome with realistic protein length distribution
+
+    Usage example:
+        genome = SyntheticGenome(n_genes=200, seed=0)
+        genome.flat_file(['hsa:1000', 'hsa:1001'])
+    """
+
+    def __init__(self, n_genes=200, n_pathways=5, pathway_size=40, seed=0):
+        """
+        :param n_genes: int number of genes
+        :param n_pathways: int number of pathways, genes are shared between pathways
+        :param pathway_size: int genes per pathway
+        :param seed: int random seed
+        """
+        rng = random.Random(seed)
+        codons = _sense_codons()
+        self.genes = {}
+        for i in range(n_genes):
+            length = int(min(max(rng.lognormvariate(0, LENGTH_SIGMA) * LENGTH_MEDIAN, MIN_LENGTH), MAX_LENGTH))
+            aa_seq = 'M' + ''.join(rng.choice(AMINO_ACIDS) for _ in range(length - 1))
+            na_seq = ''.join(rng.choice(codons[aa]) for aa in aa_seq) + STOP_CODON
+            number = GENE_ID_OFFSET + i
+            self.genes[f'hsa:{number}'] = SimpleNamespace(number=number, symbol=f'SYN{number}',
+                                                          uniprot=f'Q{number:05d}', chr=str(rng.randint(1, 22)),
+                                                          start=rng.randint(1, 10 ** 8), aa_seq=aa_seq, na_seq=na_seq)
+        gene_ids = list(self.genes)
+        self.pathways = {f'hsa{i:05d}': rng.sample(gene_ids, min(pathway_size, n_genes)) for i in range(n_pathways)}
+
+    @staticmethod
+    def _wrap(seq):
+        return '\n'.join(f'{"":12}{seq[i:i + LINE_WIDTH]}' for i in range(0, len(seq), LINE_WIDTH))
+
+    def gene_entry(self, kegg_id):
+        """
+        :param kegg_id: str
+        :return: str gene in KEGG flat-file format
+        """
+        gene = self.genes[kegg_id]
+        end = gene.start + len(gene.na_seq)
+        return (f'ENTRY       {gene.number}              CDS       T01001\n'
+                f'SYMBOL      {gene.symbol}, SYN\n'
+                f'NAME        (RefSeq) synthetic protein {gene.number}\n'
+                f'POSITION    {gene.chr}:{gene.start}..{end}\n'
+                f'DBLINKS     NCBI-GeneID: {gene.number}\n'
+                f'            UniProt: {gene.uniprot}\n'
+                f'AASEQ       {len(gene.aa_seq)}\n{self._wrap(gene.aa_seq)}\n'
+                f'NTSEQ       {len(gene.na_seq)}\n{self._wrap(gene.na_seq)}\n'
+                '///\n')
+
+    def flat_file(self, gene_ids):
+        return ''.join(self.gene_entry(kegg_id) for kegg_id in gene_ids if kegg_id in self.genes)
+
+    def fasta(self, gene_ids, seq_type='aaseq'):
+        res = ''
+        for kegg_id in gene_ids:
+            if kegg_id in self.genes:
+                seq = self.genes[kegg_id].aa_seq if seq_type == 'aaseq' else self.genes[kegg_id].na_seq
+                lines = '\n'.join(seq[i:i + LINE_WIDTH] for i in range(0, len(seq), LINE_WIDTH))
+                res += f'>{kegg_id} synthetic\n{lines}\n'
+        return res
+
+    def gene_list(self):
+        return ''.join(f'{kegg_id}\tCDS\t{gene.chr}:{gene.start}\t{gene.symbol}; synthetic\n'
+                       for kegg_id, gene in self.genes.items())
+
+    def pathway_list(self):
+        return ''.join(f'{pathway_id}\tSynthetic pathway {pathway_id}\n' for pathway_id in self.pathways)
+
+    def pathway_link(self, pathway_id):
+        return ''.join(f'path:{pathway_id}\t{kegg_id}\n' for kegg_id in self.pathways.get(pathway_id, []))
+
+    def conv_uniprot(self, gene_ids):
+        return ''.join(f'{kegg_id}\tup:{self.genes[kegg_id].uniprot}\n' for kegg_id in gene_ids
+                       if kegg_id in self.genes)
+
+    def mutations(self, n_mutations, seed=0, mismatch_rate=0.05):
+        """
+        synthetic cBio missense mutations
+        :param n_mutations: int
+        :param seed: int random seed
+        :param mismatch_rate: float fraction of mutations whose reference residue does not match the genome
+        :return: list of mutation objects with the attributes read by CbioApi.study_to_csv
+        """
+        rng = random.Random(seed)
+        genes = list(self.genes.values())
+        res = []
+        for i in range(n_mutations):
+            gene = rng.choice(genes)
+            position = rng.randint(1, len(gene.aa_seq))
+            ref = gene.aa_seq[position - 1] if rng.random() >= mismatch_rate else 'W'
+            res.append(SimpleNamespace(chr=gene.chr, startPosition=gene.start + 3 * position,
+                                       endPosition=gene.start + 3 * position, referenceAllele='A',
+                                       variantAllele='G', gene=SimpleNamespace(hugoGeneSymbol=gene.symbol),
+                                       proteinChange=f'{ref}{position}{rng.choice(AMINO_ACIDS)}',
+                                       patientId=f'P{i % 500}', uniquePatientKey=f'K{i % 500}',
+                                       sampleId=f'S{i % 700}', studyId='synthetic_study', ncbiBuild='GRCh38',
+                                       mutationType='Missense_Mutation'))
+        return res
@@ -1,3 +1,4 @@
+import os
 import pickle
 from os.path import join as pjoin
 import re
@@ -23,9 +24,15 @@ KEGG_GENES_PATH = pjoin(KEGG_PATH, 'genes')
 KEGG_PATHWAYS_PATH = pjoin(KEGG_PATH, 'pathways')
 KEGG_PATHWAY_OBJECTS_PATH = pjoin(KEGG_PATHWAYS_PATH, 'objects')
 KEGG_PATHWAY_MUTATIONS_PATH = pjoin(KEGG_PATHWAYS_PATH, 'snvs')
+KEGG_GENE_SNVS_PATH = pjoin(KEGG_PATH, 'gene_snvs')
+KEGG_GENE_EMBEDDINGS_PATH = pjoin(KEGG_PATH, 'gene_embeddings')
+KEGG_GENE_SCORES_PATH = pjoin(KEGG_PATH, 'gene_scores')
+GENE_CACHE_PATHS = (KEGG_GENE_SNVS_PATH, KEGG_GENE_EMBEDDINGS_PATH, KEGG_GENE_SCORES_PATH)
+JOURNALS_PATH = pjoin(DB, 'journals')
 
 DIRS_TO_CREATE = [DB, CBIO_PATH, KEGG_PATH, STUDIES_PATH, KEGG_GENES_PATH, KEGG_PATHWAYS_PATH,
-                  KEGG_PATHWAY_OBJECTS_PATH,KEGG_PATHWAY_MUTATIONS_PATH]
+                  KEGG_PATHWAY_OBJECTS_PATH,KEGG_PATHWAY_MUTATIONS_PATH, KEGG_GENE_SNVS_PATH,
+                  KEGG_GENE_EMBEDDINGS_PATH, KEGG_GENE_SCORES_PATH, JOURNALS_PATH]
 
 #   REQUESTS AND OS CONSTANTS
 
@@ -36,18 +43,44 @@ RETRY_STATUS_LIST = [429, 500, 502, 503, 504, 403, 400]
 DEFAULT_HEADER = "https://"
 WORKERS = None  # use default amount of CPUs
 KEG_API_RECOMMENDED_WORKERS = 6
+KEGG_POOL_SIZE = KEG_API_RECOMMENDED_WORKERS  # default connections kept alive to KEGG
+HTTP_HEADERS = {'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'}
+
+#  METRICS
+
+METRICS_ENV = 'PATHWAY_ATLAS_METRICS'  # set to 1 to collect metrics from import time
+METRICS_PREFIX = 'pathway_atlas_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#  JOB JOURNALS
+
+JOURNAL_DONE = 'done'
+JOURNAL_FAILED = 'failed'
+JOURNAL_SEED = 'seed'  # batch key of items adopted from DB when a journal is created
+JOURNAL_SKIPPED_ERROR = 'items not completed by target'
+JOB_RETRIES = 3  # extra rounds for batches that failed
+TMP_SUFFIX = '.tmp'
+
+#  PIPELINE
+
+PIPELINE_QUEUE_SIZE = 64  # max items waiting between two stages
+PIPELINE_STAGES = ('fetch', 'snvs', 'embed', 'score')
+SNV_WORKERS = 4
+EMBED_WORKERS = 1
+SCORE_WORKERS = 1
 
 #  BIOLOGIC CONSTANTS
 
 NA_COUPLE = {'a': 't', 't': 'a', 'c': 'g', 'g': 'c'}
 NA_CHANGE = {'a': 'tcg', 't': 'acg', 'c': 'gta', 'g': 'cta'}
+NA_ORDER = 'acgt'  # codon index is 16 * i(n1) + 4 * i(n2) + i(n3)
 STOP_CODONS = ['tag', 'taa', 'tga']
 STOP_AA = '_'
 CODON_LENGTH = 3
 CODON_TRANSLATOR = {'ata': 'I', 'atc': 'I', 'att': 'I', 'atg': 'M', 'aca': 'T',
                     'acc': 'T', 'acg': 'T', 'act': 'T', 'aac': 'N', 'aat': 'N',
                     'aaa': 'K', 'aag': 'K', 'agc': 'S', 'agt': 'S', 'aga': 'R',
-                    'agg': 'R', 'cta': 'L', 'ctc': ' L', 'ctg': 'L', 'ctt': 'L',
+                    'agg': 'R', 'cta': 'L', 'ctc': 'L', 'ctg': 'L', 'ctt': 'L',
                     'cca': 'P', 'ccc': 'P', 'ccg': 'P', 'cct': 'P', 'cac': 'H',
                     'cat': 'H', 'caa': 'Q', 'cag': 'Q', 'cga': 'R', 'cgc': 'R',
                     'cgg': 'R', 'cgt': 'R', 'gta': 'V', 'gtc': 'V', 'gtg': 'V',
@@ -58,9 +91,17 @@ CODON_TRANSLATOR = {'ata': 'I', 'atc': 'I', 'att': 'I', 'atg': 'M', 'aca': 'T',
                     'ttg': 'L', 'tac': 'Y', 'tat': 'Y', 'taa': '_', 'tag': '_',
                     'tgc': 'C', 'tgt': 'C', 'tga': '_', 'tgg': 'W'}
 
+#  ESM
+
+ESM_MODEL = 'esm1b_t33_650M_UR50S'
+ESM_MAX_LEN = 1022  # longer proteins are embedded in consecutive windows
+ESM_AA_ORDER = 'ACDEFGHIKLMNPQRSTVWY'
+
 #  FAMANALYSIS
 
 FAMANALYSIS_COLUMNS = ['Chr', 'Start', 'End', 'Ref', 'Alt', 'Protein', 'Variant']
+#  compact per gene SNV cache, 8 bytes per variant. Chr and Protein are constant per gene and Variant is derived
+SNV_DTYPE = [('pos', '<u4'), ('ref', 'S1'), ('alt', 'S1'), ('ref_aa', 'S1'), ('alt_aa', 'S1')]
 
 #   CBIOPORTAL
 
@@ -71,11 +112,16 @@ CBIO_CANCER_TYPES = load_dict(CANCER_TYPES_DIR)
 STUDY_COLUMNS = FAMANALYSIS_COLUMNS + ['PatientId', 'PatientKey', 'SampleId', 'StudyId', 'RefDNA']
 # exclude only on patient key and protein change to avoid problems with hg19/hg18
 DUPLICATE_EXCLUSION_COLUMNS = FAMANALYSIS_COLUMNS + ['PatientKey']
+# missense protein change e.g. V600E, optional p. prefix
+PROTEIN_CHANGE_RE = r'^(?:p\.)?([A-Z])(\d+)([A-Z])$'
+# added by CbioApi.validate_protein_changes, AAPosition is 1-based and CodonStart is a 0-based index in na_seq
+# HasReference is false for genes without a reference sequence, their Valid is always false
+VALIDATION_COLUMNS = ['RefAA', 'AAPosition', 'AltAA', 'SeqAA', 'Codon', 'CodonStart', 'HasReference', 'Valid']
 
 #  KEGG
 KEGG_HSA_PATHWAYS_DIR = pjoin(KEGG_PATH, 'kegg_hsa_pathways.pickle')  # {pathway_id : desc}
 
-KEGG_API_URL = 'https://rest.kegg.jp'
+KEGG_API_URL = os.environ.get('KEGG_API_URL', 'https://rest.kegg.jp')  # overridden by benchmarks
 COMMAND_TYPES = ['link', 'list', 'conv', 'get']
 KEGG_LIST_COMMAND = KEGG_API_URL + '/list/{}/{}'
 KEGG_LINK_COMMAND = KEGG_API_URL + '/link/{}/{}'
@@ -95,6 +141,9 @@ GENE_SEPERATOR = '///\n'
 
 GENE_DATA = {'kegg_id': None, 'uniprot_id': None, 'aa_seq': '', 'na_seq': '',
              'chr': None, 'start': None, 'end': None, 'coding_type': None, 'ref_names': None}
+GENE_METADATA = ('kegg_id', 'uniprot_id', 'ref_names', 'chr', 'start', 'end', 'coding_type')
+GENE_SEQUENCES = ('aa_seq', 'na_seq')
+GENE_TABLE_COLUMNS = list(GENE_METADATA) + ['aa_len', 'na_len']
 
 KEG_POSITION_RE = "(\d+)\.{2}(\d+)"
 
@@ -102,5 +151,7 @@ KEG_POSITION_RE = "(\d+)\.{2}(\d+)"
 
 NETWORK_TYPE_ERROR = f'Network type must be one of: {", ".join(NETWORK_TYPES)}'
 NETWORK_ID_ERROR = f'KEGG id must be of a KEGG module or KEGG pathway'
+KEGG_POOL_SIZE_WARNING = 'KEGG connection pool was created for {1} workers, {0} requested. ' \
+                         'Call kegg_session with the largest worker count before starting workers'
 LOAD_OBJ_ERROR = 'Data missing or invalid for {}. ' \
                  '\nDelete instance from DB and recreate the object'
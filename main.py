@@ -1,34 +1,221 @@
+import argparse
 from utils import *
 from Kegg import *
+from pipeline import Pipeline
+from metrics import METRICS
+
+
+def create_genes(*gene_ids):
+    """
+    creates KeggGene objects from a single KEGG request
+    :param gene_ids: at most KEGG_MAX_IDS kegg gene ids
+    :return: list of created gene ids, in rare cases KEGG skips some genes
+    """
+    kegg = KeggApi()
+    genes_dict = kegg.genes_info(list(gene_ids))
+    for kegg_id, data in genes_dict.items():
+        gene = KeggGene(kegg_id, default_init=False, load=False)
+        gene.create_from_dict(data)
+    return list(genes_dict.keys())
+
 
 def init_kegg_genome(recalc=False):
-    genes = KeggApi().get_all_genes().keys()
-    if not recalc:
-        genes = set(genes) - kegg_genes_in_dataset()
-    genes = list(genes)
-    def objects_creator(*gene_ids):
-        kegg = KeggApi()
-        genes_dict = kegg.genes_info(list(gene_ids))
-        for kegg_id, data in genes_dict.items():
-            gene = KeggGene(kegg_id, default_init=False)
-            gene.create_from_dict(data)
-
-    target = objects_creator
+    """
+    creates a KeggGene object for every gene in the KEGG genome
+    progress is recorded in a job journal, an interrupted run resumes from the last committed batch
+    :param recalc: bool if true discard previous progress and recreate all genes
+    :return: list of batches that failed after all retries
+    """
+    #  genes already in DB are adopted once when the journal is created
+    #  files left empty or truncated by a crash are not adopted, they are recreated like any pending gene
+    seed = None if recalc else lambda: kegg_genes_in_dataset(check=True)
+    journal = JobJournal('genome', reset=recalc, seed=seed)
+    genes = journal.pending(KeggApi(pool_size=KEG_API_RECOMMENDED_WORKERS).get_all_genes().keys())
+    target = create_genes
     #  at most 10 genes per request
-    tasks = [genes[i: i + KEGG_MAX_IDS] for i in range(0, len(genes), KEGG_MAX_IDS)]
-    multiprocess_task(tasks=tasks, target=target, workers=KEG_API_RECOMMENDED_WORKERS)
+    tasks = journal.batch(genes, KEGG_MAX_IDS)
+    return journal.run(batches=tasks, target=target, workers=KEG_API_RECOMMENDED_WORKERS)
 
 
-if __name__ == '__main__':
-    init_kegg_genome()
-    #  get all KEGG pathways and modules
+def init_kegg_networks(network_type='pathway', recalc=False):
     """
+    creates a KeggNetwork object for every KEGG pathway or module
+    :param network_type: one of module | pathway
+    :param recalc: bool if true discard previous progress
+    :return: list of batches that failed after all retries
+    """
+    network_type = network_type.lower()
+    assert network_type in NETWORK_TYPES, NETWORK_TYPE_ERROR
     kegg = KeggApi()
-    pathways = kegg.get_all_pathways()
-    modules = kegg.get_all_modules()
+    network_ids = kegg.get_all_pathways() if network_type == 'pathway' else kegg.get_all_modules()
+    journal = JobJournal(f'networks_{network_type}', reset=recalc)
+    tasks = journal.batch(journal.pending(network_ids.keys()), 1)
+    #  each network already fetches its genes with multiple workers
+    def create_network(kegg_id):
+        KeggNetwork(kegg_id, network_type)
+
+    return journal.run(batches=tasks, target=create_network, workers=1)
+
+
+def export_networks_snvs(network_type='pathway', recalc=False, to_csv=False):
+    """
+    caches the single nucleotide variants of every gene in KEGG pathways or modules
+    each gene is computed and stored once in KEGG_GENE_SNVS_PATH however many networks include it
+    :param network_type: one of module | pathway
+    :param recalc: bool if true discard previous progress
+    :param to_csv: bool also save a csv of every network to KEGG_PATHWAY_MUTATIONS_PATH
+    :return: list of batches that failed after all retries
+    """
+    network_type = network_type.lower()
+    assert network_type in NETWORK_TYPES, NETWORK_TYPE_ERROR
+    networks_journal = JobJournal(f'networks_{network_type}')
+    journal = JobJournal(f'snvs_{network_type}' + ('_csv' if to_csv else ''), reset=recalc)
+    tasks = journal.batch(journal.pending(networks_journal.completed_items()), 1)
+    def export_snvs(kegg_id):
+        network = KeggNetwork(kegg_id, network_type)
+        if to_csv:
+            network.all_snvs()
+        else:
+            network.snv_blocks()
+
+    return journal.run(batches=tasks, target=export_snvs, workers=1)
+
+
+def run_gene_pipeline(gene_ids=None, stages=PIPELINE_STAGES, fetch_workers=KEG_API_RECOMMENDED_WORKERS,
+                      snv_workers=SNV_WORKERS, embed_workers=EMBED_WORKERS, score_workers=SCORE_WORKERS,
+                      queue_size=PIPELINE_QUEUE_SIZE, model_name=ESM_MODEL):
+    """
+    runs fetch -> snvs -> embed -> score over genes, stages work concurrently on different genes
+    genes whose stage results are already in DB skip that stage
+    :param gene_ids: optional list of kegg gene ids, defaults to the whole KEGG genome
+    :param stages: consecutive stages of PIPELINE_STAGES to run, starting from fetch
+    :param fetch_workers: int concurrent KEGG requests
+    :param snv_workers: int SNV generation workers
+    :param embed_workers: int ESM inference workers
+    :param score_workers: int SNV scoring workers
+    :param queue_size: int max genes waiting between two stages
+    :param model_name: str esm model name
+    :return: dict {stage name: {processed, skipped, failed}}
     """
-    #  example get all variants in a pathway
+    assert tuple(stages) == PIPELINE_STAGES[:len(stages)], f'stages must be a prefix of {PIPELINE_STAGES}'
+    kegg = KeggApi(pool_size=fetch_workers)
+    if gene_ids is None:
+        gene_ids = list(kegg.get_all_genes().keys())
+    gene_exists = lambda kegg_id: os.path.exists(KeggGene.gene_path(kegg_id))
+    cached = lambda directory: lambda kegg_id: os.path.exists(KeggGene.cache_path(kegg_id, directory))
+    embedder = ESMEmbedding(model_name) if 'embed' in stages else None
+
+    def fetch(batch):
+        created = create_genes(*batch)
+        #  genes KEGG skipped are not passed on, count them as failed
+        for kegg_id in sorted(set(batch) - set(created)):
+            fetch_stage.fail(kegg_id, JOURNAL_SKIPPED_ERROR)
+        return created
+
+    def snvs(kegg_id):
+        KeggGene(kegg_id).snv_block()
+        return kegg_id
+
+    def embed(kegg_id):
+        KeggGene(kegg_id).esm_probabilities(embedder)
+        return kegg_id
+
+    def score(kegg_id):
+        KeggGene(kegg_id).snv_scores()
+        return kegg_id
+
+    pipeline = Pipeline()
+    fetch_stage = pipeline.add_stage('fetch', fetch, workers=fetch_workers, queue_size=queue_size,
+                                     skip=lambda batch: all(gene_exists(kegg_id) for kegg_id in batch), fan_out=True)
+    targets = {'snvs': (snvs, snv_workers, KEGG_GENE_SNVS_PATH),
+               'embed': (embed, embed_workers, KEGG_GENE_EMBEDDINGS_PATH),
+               'score': (score, score_workers, KEGG_GENE_SCORES_PATH)}
+    for upstream, name in zip(stages, stages[1:]):
+        target, workers, directory = targets[name]
+        pipeline.add_stage(name, target, workers=workers, after=upstream, queue_size=queue_size,
+                           skip=cached(directory))
+    return pipeline.run(read_in_chunks(gene_ids, KEGG_MAX_IDS))
+
+
+def download_studies(keyword, download_workers=KEG_API_RECOMMENDED_WORKERS, validate=False, drop_invalid=False):
     """
-    pathway_obj = KeggNetwork('hsa01200', 'pathway')
-    KeggNetwork.all_snvs(outpath='test.csv')
+    downloads cBio mutations of all studies of a cancer type to STUDIES_PATH
+    downloading and exporting run concurrently, studies already in DB are skipped
+    :param keyword: abbreviated cancer type
+    :param download_workers: int concurrent cBio requests
+    :param validate: bool validate protein changes against KEGG sequences
+    :param drop_invalid: bool drop mutations that do not match KEGG sequences
+    :return: dict {stage name: {processed, skipped, failed}}
     """
+    cbio = CbioApi()
+    study_ids, _ = cbio.all_studies_by_keyword(keyword)
+    sequences = KeggGene.sequence_table(kegg_genes_in_dataset()) if validate else None
+    study_path = lambda study: pjoin(STUDIES_PATH, f'{study}.csv')
+
+    def download(study):
+        return study, cbio.download_study_mutations(study).result()
+
+    def export(downloaded):
+        study, mutations = downloaded
+        CbioApi.study_to_csv(mutations, outpath=study_path(study), sequences=sequences, drop_invalid=drop_invalid)
+
+    pipeline = Pipeline()
+    pipeline.add_stage('download', download, workers=download_workers,
+                       skip=lambda study: os.path.exists(study_path(study)))
+    #  skipped studies reach export as ids only
+    pipeline.add_stage('export', export, after='download', skip=lambda item: isinstance(item, str))
+    return pipeline.run(study_ids)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='PathwayAtlas jobs')
+    parser.add_argument('--metrics', help='collect metrics and save them to this path, .prom for Prometheus text '
+                                          'format otherwise json')
+    jobs = parser.add_subparsers(dest='job', required=True)
+    genome = jobs.add_parser('genome', help='create all KEGG genes')
+    genome.add_argument('--recalc', action='store_true', help='discard previous progress')
+    for job, job_help in (('networks', 'create all KEGG networks'), ('snvs', 'export SNVs of all KEGG networks')):
+        network = jobs.add_parser(job, help=job_help)
+        network.add_argument('--type', default='pathway', choices=NETWORK_TYPES)
+        network.add_argument('--recalc', action='store_true', help='discard previous progress')
+        if job == 'snvs':
+            network.add_argument('--csv', action='store_true', help='also save a csv of every network')
+    pipeline = jobs.add_parser('pipeline', help='fetch -> snvs -> embed -> score')
+    pipeline.add_argument('--stages', nargs='+', default=list(PIPELINE_STAGES), choices=PIPELINE_STAGES)
+    pipeline.add_argument('--network', help='only run on genes of this KEGG pathway or module')
+    pipeline.add_argument('--fetch-workers', type=int, default=KEG_API_RECOMMENDED_WORKERS)
+    pipeline.add_argument('--snv-workers', type=int, default=SNV_WORKERS)
+    pipeline.add_argument('--embed-workers', type=int, default=EMBED_WORKERS)
+    pipeline.add_argument('--score-workers', type=int, default=SCORE_WORKERS)
+    pipeline.add_argument('--queue-size', type=int, default=PIPELINE_QUEUE_SIZE)
+    pipeline.add_argument('--model', default=ESM_MODEL, help='esm model name')
+    studies = jobs.add_parser('studies', help='download cBio studies of a cancer type')
+    studies.add_argument('keyword', help='abbreviated cancer type')
+    studies.add_argument('--workers', type=int, default=KEG_API_RECOMMENDED_WORKERS)
+    studies.add_argument('--validate', action='store_true', help='validate protein changes against KEGG')
+    studies.add_argument('--drop-invalid', action='store_true', help='drop mutations that do not match KEGG')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.metrics:
+        METRICS.enable()
+    #  the shared KEGG connection pool is sized once, before any job starts its workers
+    kegg_session(max(KEG_API_RECOMMENDED_WORKERS, getattr(args, 'fetch_workers', 0)))
+    if args.job == 'genome':
+        init_kegg_genome(recalc=args.recalc)
+    elif args.job == 'networks':
+        init_kegg_networks(args.type, recalc=args.recalc)
+    elif args.job == 'snvs':
+        export_networks_snvs(args.type, recalc=args.recalc, to_csv=args.csv)
+    elif args.job == 'pipeline':
+        genes = sorted(KeggApi().get_gene_list(args.network)) if args.network else None
+        print(run_gene_pipeline(genes, stages=args.stages, fetch_workers=args.fetch_workers,
+                                snv_workers=args.snv_workers, embed_workers=args.embed_workers,
+                                score_workers=args.score_workers, queue_size=args.queue_size, model_name=args.model))
+    elif args.job == 'studies':
+        print(download_studies(args.keyword, download_workers=args.workers, validate=args.validate,
+                               drop_invalid=args.drop_invalid))
+    if args.metrics:
+        METRICS.save(args.metrics)
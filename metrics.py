@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from definitions import *
+
+_NULL_TIMER = nullcontext()
+
+
+class Metrics:
+    """
+    thread safe counters and latency histograms, every call is a no-op while disabled
+
+    Usage example:
+        METRICS.enable()
+        with METRICS.timer('stage_seconds', stage='parse'):
+            ...
+        METRICS.inc('kegg_responses_total', command='get', status=200)
+        METRICS.save('metrics.prom')
+    """
+
+    def __init__(self, enabled=False, buckets=LATENCY_BUCKETS):
+        """
+        :param enabled: bool collect metrics
+        :param buckets: sorted tuple of histogram upper bounds in seconds
+        """
+        self.enabled, self.buckets = enabled, tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = defaultdict(float)
+            self._histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        :param name: str counter name
+        :param value: number to add
+        :param labels: label values
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        """
+        :param name: str histogram name
+        :param value: float observed value
+        :param labels: label values
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timer(self, name, **labels):
+        """
+        context manager observing its duration in histogram name
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(name, labels)
+
+    def timed(self, name, **labels):
+        """
+        decorator observing the duration of every call in histogram name
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._timer(name, labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        :return: dict {counters: [...], histograms: [...]}, histogram buckets are cumulative
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative, total = {}, 0
+                for bound, count in zip(self.buckets + ('+Inf',), histogram['counts']):
+                    total += count
+                    cumulative[str(bound)] = total
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': cumulative,
+                                   'sum': histogram['sum'], 'count': histogram['count']})
+        return {'timestamp': time.time(), 'counters': counters, 'histograms': histograms}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in labels.items()) + '}'
+
+    def to_prometheus(self):
+        """
+        :return: str snapshot in Prometheus text exposition format
+        """
+        snapshot, lines, typed = self.snapshot(), [], set()
+        for counter in snapshot['counters']:
+            name = METRICS_PREFIX + counter['name']
+            if name not in typed:
+                lines.append(f'# TYPE {name} counter')
+                typed.add(name)
+            lines.append(f'{name}{self._labels(counter["labels"])} {counter["value"]}')
+        for histogram in snapshot['histograms']:
+            name = METRICS_PREFIX + histogram['name']
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            for bound, count in histogram['buckets'].items():
+                lines.append(f'{name}_bucket{self._labels(histogram["labels"], le=bound)} {count}')
+            lines.append(f'{name}_sum{self._labels(histogram["labels"])} {histogram["sum"]}')
+            lines.append(f'{name}_count{self._labels(histogram["labels"])} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """
+        :param path: str, Prometheus text format if path ends with .prom otherwise json
+        """
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+
+METRICS = Metrics(enabled=os.environ.get(METRICS_ENV, '') not in ('', '0'))
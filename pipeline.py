@@ -0,0 +1,147 @@
+import queue
+import threading
+import warnings
+from collections import defaultdict
+from definitions import *
+from metrics import METRICS
+
+_STOP = object()  # sentinel closing a stage queue
+
+
+class Stage:
+    """single pipeline stage, consumes its input queue with its own pool of worker threads"""
+
+    def __init__(self, name, target, workers=1, queue_size=PIPELINE_QUEUE_SIZE, skip=None, fan_out=False):
+        """
+        :param name: str stage name
+        :param target: callable item -> result, None results are not passed on
+        :param workers: int number of worker threads
+        :param queue_size: int max items waiting for this stage, upstream stages block when it is full
+        :param skip: optional callable item -> bool, true if the item was already processed
+        skipped items are passed downstream unchanged
+        :param fan_out: bool if true target returns an iterable and each element is passed on separately
+        """
+        self.name, self.target, self.workers = name, target, workers
+        self.skip, self.fan_out = skip, fan_out
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed, self.skipped, self.failed = 0, 0, []
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def process(self, item):
+        """
+        :param item: stage input
+        :return: list of outputs to pass downstream
+        """
+        if self.skip is not None and self.skip(item):
+            with self._lock:
+                self.skipped += 1
+            return list(item) if self.fan_out else [item]
+        with METRICS.timer('stage_seconds', stage=f'pipeline_{self.name}'):
+            result = self.target(item)
+        with self._lock:
+            self.processed += 1
+        if result is None:
+            return []
+        return list(result) if self.fan_out else [result]
+
+    def fail(self, item, error):
+        """
+        records an item the stage could not process
+        :param item: stage input or the part of it that failed
+        :param error: str
+        """
+        METRICS.inc('pipeline_failures_total', stage=self.name)
+        warnings.warn(f'[{self.name}] failed on {item}: {error}')
+        with self._lock:
+            self.failed.append((item, error))
+
+    def worker_done(self):
+        """
+        :return: bool true if the calling worker was the last one running
+        """
+        with self._lock:
+            self._running -= 1
+            return self._running == 0
+
+    def summary(self):
+        return {'processed': self.processed, 'skipped': self.skipped, 'failed': len(self.failed)}
+
+
+class Pipeline:
+    """
+    DAG of stages connected by bounded queues, stages run concurrently on different items
+
+    Usage example:
+        pipeline = Pipeline()
+        pipeline.add_stage('fetch', fetch, workers=6, fan_out=True)
+        pipeline.add_stage('snvs', snvs, workers=4, after='fetch')
+        summary = pipeline.run(batches)
+    """
+
+    def __init__(self):
+        """Constructor for Pipeline"""
+        self.stages = {}
+        self.children = defaultdict(list)
+        self.roots = []
+
+    def add_stage(self, name, target, workers=1, after=None, queue_size=PIPELINE_QUEUE_SIZE, skip=None,
+                  fan_out=False):
+        """
+        :param name: str unique stage name
+        :param after: optional str name of upstream stage, if not given stage consumes the pipeline input
+        see Stage for other parameters
+        :return: Stage
+        """
+        assert name not in self.stages, f'stage {name} already exists'
+        assert after is None or after in self.stages, f'unknown upstream stage {after}'
+        stage = Stage(name, target, workers=workers, queue_size=queue_size, skip=skip, fan_out=fan_out)
+        self.stages[name] = stage
+        if after is None:
+            self.roots.append(stage)
+        else:
+            self.children[after].append(stage)
+        return stage
+
+    def _close(self, stages):
+        for stage in stages:
+            for _ in range(stage.workers):
+                stage.queue.put(_STOP)
+
+    def _worker(self, stage):
+        children = self.children[stage.name]
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            try:
+                outputs = stage.process(item)
+            except Exception as e:
+                stage.fail(item, repr(e))
+                continue
+            for output in outputs:
+                for child in children:
+                    child.queue.put(output)
+        if stage.worker_done():
+            self._close(children)
+
+    def _feed(self, items):
+        for item in items:
+            for stage in self.roots:
+                stage.queue.put(item)
+        self._close(self.roots)
+
+    def run(self, items):
+        """
+        runs all stages until every item passed through the pipeline
+        :param items: iterable of inputs for the root stages
+        :return: dict {stage name: {processed, skipped, failed}}
+        """
+        threads = [threading.Thread(target=self._worker, args=(stage,), name=f'{stage.name}_{i}', daemon=True)
+                   for stage in self.stages.values() for i in range(stage.workers)]
+        threads.append(threading.Thread(target=self._feed, args=(items,), name='feeder', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {name: stage.summary() for name, stage in self.stages.items()}
@@ -2,6 +2,7 @@ import os
 import warnings
 from definitions import *
 from bravado.client import SwaggerClient
+import numpy as np
 import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter, Retry
@@ -10,8 +11,14 @@ from multiprocessing.pool import ThreadPool as Pool
 import copy
 import re
 import glob
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import partial
 from esm import pretrained
 import torch
+from metrics import METRICS
 
 
 snake_format = lambda s: s.replace(' ', '_').replace('-', '_').lower()
@@ -22,8 +29,38 @@ def read_in_chunks(array, chunk_size):
         yield array[i:i + chunk_size]
 
 
+#  read once at import, os.umask can only be queried by setting it which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    writes to a temporary file in the same directory and renames it to path on success
+    a crash mid-write leaves the previous version of path (if any) untouched
+    :param path: str destination path
+    :param mode: str file mode 'wb' | 'w'
+    :return: file object
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'.{name}.', suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(fd, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        #  mkstemp creates owner-only files, keep the mode a plain open() would give
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def save_dict(data, path):
-    with open(path, 'wb') as f:
+    with atomic_write(path) as f:
         pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
 
 
@@ -33,7 +70,7 @@ def load_dict(path):
 
 
 def save_obj(obj, path):
-    with open(path, "wb") as file:
+    with METRICS.timer('stage_seconds', stage='save_obj'), atomic_write(path) as file:
         pickle.dump(obj.__dict__, file)
 
 
@@ -45,24 +82,88 @@ def load_obj(obj, path, name=''):
             raise NameError(LOAD_OBJ_ERROR.format(name))
 
 
-def create_session(header, retries=5, wait_time=0.5, status_forcelist=None):
+def save_obj_sections(path, *sections):
+    """
+    pickles each section one after the other so they can be loaded independently
+    :param path: str
+    :param sections: picklable objects
+    """
+    with METRICS.timer('stage_seconds', stage='save_obj'), atomic_write(path) as file:
+        for section in sections:
+            pickle.dump(section, file, pickle.HIGHEST_PROTOCOL)
+
+
+def load_obj_section(path, offset=0, name=''):
+    """
+    loads a single section saved by save_obj_sections
+    :param path: str
+    :param offset: int byte offset of the section, 0 for the first one
+    :param name: str object name for error message
+    :return: tuple (section, offset of the next section)
+    """
+    if os.path.getsize(path) <= offset:
+        raise NameError(LOAD_OBJ_ERROR.format(name))
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        section = pickle.load(file)
+        return section, file.tell()
+
+
+class CountingRetry(Retry):
+    """urllib3 Retry counting every retry in METRICS"""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if METRICS.enabled:
+            reason = response.status if response is not None else type(error).__name__
+            METRICS.inc('http_retries_total', reason=reason)
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool,
+                                 _stacktrace=_stacktrace)
+
+
+def create_session(header, retries=5, wait_time=0.5, status_forcelist=None, pool_size=KEGG_POOL_SIZE):
     """
     Creates a session using pagination
     :param header: str url header session eill apply to
     :param retries: int number of retries on failure
     :param wait_time: float time (sec) between attempts
     :param status_forcelist: list HTTP status codes that we should force a retry on
+    :param pool_size: int max connections kept alive per host, should match the number of workers
     :return: requests session
     """
     s = requests.Session()
-    retries = Retry(total=retries,
-                    backoff_factor=wait_time,
-                    status_forcelist=status_forcelist)
+    s.headers.update(HTTP_HEADERS)
+    retries = CountingRetry(total=retries,
+                            backoff_factor=wait_time,
+                            status_forcelist=status_forcelist)
 
-    s.mount(header, HTTPAdapter(max_retries=retries))
+    s.mount(header, HTTPAdapter(max_retries=retries, pool_maxsize=pool_size))
     return s
 
 
+_kegg_session, _kegg_pool_size = None, 0
+_kegg_session_lock = threading.Lock()
+
+
+def kegg_session(pool_size=KEGG_POOL_SIZE):
+    """
+    process-wide KEGG session shared by all KeggApi instances and threads so connections are kept alive
+    the pool is sized once when the session is created, the first call should pass the largest number of workers
+    that will query KEGG concurrently, before any of them start
+    :param pool_size: int number of workers that will query KEGG concurrently
+    :return: requests session
+    """
+    global _kegg_session, _kegg_pool_size
+    with _kegg_session_lock:
+        if _kegg_session is None:
+            _kegg_session = create_session(KEGG_API_URL, retries=RETRIES, wait_time=WAIT_TIME,
+                                           status_forcelist=RETRY_STATUS_LIST, pool_size=pool_size)
+            _kegg_pool_size = pool_size
+        elif pool_size > _kegg_pool_size:
+            #  connections beyond the pool still work but are not kept alive
+            warnings.warn(KEGG_POOL_SIZE_WARNING.format(pool_size, _kegg_pool_size))
+        return _kegg_session
+
+
 def safe_get_request(session, url, timeout=TIMEOUT, warning_msg='connection failed', return_on_failure=None):
     """
     creates a user friendly request raises warning on ConnectionError but will not crush
@@ -77,6 +178,7 @@ def safe_get_request(session, url, timeout=TIMEOUT, warning_msg='connection fail
     try:
         r = session.get(url, timeout=timeout)
     except requests.exceptions.ConnectionError as e:
+        METRICS.inc('http_connection_errors_total')
         warnings.warn(warning_msg)
         return return_on_failure
     return r
@@ -96,8 +198,178 @@ def multiprocess_task(tasks, target, workers=None, callback=lambda x: x):
             callback(status)
 
 
-def kegg_genes_in_dataset():
-    return {os.path.basename(path)[:-7].replace('_', ':') for path in glob.glob(pjoin(KEGG_GENES_PATH, '*'))}
+def obj_sections_loadable(path):
+    """
+    :param path: str path saved by save_obj_sections
+    :return: bool true if every section unpickles, false for empty or truncated files
+    """
+    try:
+        offset, size = 0, os.path.getsize(path)
+        while offset < size:
+            _, offset = load_obj_section(path, offset=offset)
+    except Exception:  # truncated pickles raise EOFError, UnpicklingError and others
+        return False
+    return size > 0
+
+
+def kegg_genes_in_dataset(check=False):
+    """
+    :param check: bool if true only genes whose object loads completely are returned
+    :return: set of kegg gene ids in DB
+    """
+    paths = glob.glob(pjoin(KEGG_GENES_PATH, '*.pickle'))
+    if check:
+        paths = [path for path in paths if obj_sections_loadable(path)]
+    return {os.path.basename(path)[:-7].replace('_', ':') for path in paths}
+
+
+class JobJournal:
+    """
+    append-only journal of the batches a long job has completed
+
+    each line records a batch key, its items and whether it was committed or failed.
+    on restart the journal is replayed so committed batches are skipped without scanning the data directories.
+
+    Usage example:
+        journal = JobJournal('genome')
+        batches = journal.batch(journal.pending(all_genes), KEGG_MAX_IDS)
+        journal.run(batches, target=objects_creator, workers=KEG_API_RECOMMENDED_WORKERS)
+    """
+
+    def __init__(self, name, directory=JOURNALS_PATH, reset=False, seed=None):
+        """
+        :param name: str job name, journal is saved as <directory>/<name>.jsonl
+        :param directory: str journals directory
+        :param reset: bool if true previous journal is discarded
+        :param seed: optional callable returning items already completed before the journal existed
+        called only when a new journal is created, e.g. to adopt objects already in DB
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self.path = pjoin(directory, f'{name}.jsonl')
+        self.done, self.failed = {}, {}
+        self._lock = threading.Lock()
+        if reset and os.path.exists(self.path):
+            os.remove(self.path)
+        if os.path.exists(self.path):
+            self._load()
+        elif seed is not None:
+            items = sorted(seed())
+            if items:
+                self.commit(items, key=JOURNAL_SEED)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # last line may be torn if the job crashed mid-write
+                    continue
+                key = entry['batch']
+                if entry['status'] == JOURNAL_DONE:
+                    self.done[key] = entry['items']
+                    self.failed.pop(key, None)
+                else:
+                    self.failed[key] = entry['items']
+
+    def _append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+
+    @staticmethod
+    def batch_key(items):
+        return '+'.join(str(item) for item in items)
+
+    @staticmethod
+    def batch(items, batch_size):
+        """
+        :param items: list of items
+        :param batch_size: int
+        :return: list of batches (lists)
+        """
+        return [list(chunk) for chunk in read_in_chunks(list(items), batch_size)]
+
+    def commit(self, items, key=None):
+        key = key or self.batch_key(items)
+        self._append({'batch': key, 'items': list(items), 'status': JOURNAL_DONE})
+        with self._lock:
+            self.done[key] = list(items)
+            self.failed.pop(key, None)
+
+    def fail(self, items, error=''):
+        key = self.batch_key(items)
+        self._append({'batch': key, 'items': list(items), 'status': JOURNAL_FAILED, 'error': error})
+        with self._lock:
+            self.failed[key] = list(items)
+
+    def completed_items(self):
+        """
+        :return: set of all items in committed batches
+        """
+        return {item for items in self.done.values() for item in items}
+
+    def pending(self, items):
+        """
+        :param items: iterable of items
+        :return: list of items not yet committed, order is preserved
+        """
+        completed = self.completed_items()
+        return [item for item in items if item not in completed]
+
+    def outstanding_failures(self):
+        """
+        :return: list of failed batches whose items were not committed since
+        """
+        completed = self.completed_items()
+        return [items for key, items in self.failed.items()
+                if key not in self.done and not set(items) <= completed]
+
+    def _run_batch(self, target, *items):
+        try:
+            completed = target(*items)
+        except Exception as e:
+            warnings.warn(f'[{self.name}] batch {self.batch_key(items)} failed: {e!r}')
+            self.fail(items, error=repr(e))
+            return False
+        if completed is None:
+            self.commit(items)
+            return True
+        completed = set(completed)
+        done = [item for item in items if item in completed]
+        missing = [item for item in items if item not in completed]
+        if done:
+            self.commit(done)
+        if missing:
+            warnings.warn(f'[{self.name}] batch {self.batch_key(items)} skipped {self.batch_key(missing)}')
+            self.fail(missing, error=JOURNAL_SKIPPED_ERROR)
+        return not missing
+
+    def run(self, batches, target, workers=None, retries=JOB_RETRIES):
+        """
+        runs target(*batch) for every batch not yet committed, each batch is committed as soon as it finishes.
+        target may return the items it completed, the rest of the batch is then recorded as failed.
+        if target returns None the whole batch is committed.
+        batches that failed are retried separately, one batch at a time, up to retries extra rounds
+        :param batches: list of iterables
+        :param target: callable
+        :param workers: optional int number of workers
+        :param retries: int number of retry rounds for failed batches
+        :return: list of batches that still failed
+        """
+        batches = [list(items) for items in batches if self.batch_key(items) not in self.done]
+        multiprocess_task(tasks=batches, target=partial(self._run_batch, target), workers=workers)
+        for _ in range(retries):
+            failed = self.outstanding_failures()
+            if not failed:
+                break
+            multiprocess_task(tasks=failed, target=partial(self._run_batch, target), workers=1)
+        return self.outstanding_failures()
 
 class CbioApi:
     """api for cbio portal"""
@@ -135,14 +407,18 @@ class CbioApi:
         return muts
 
     @staticmethod
-    def study_to_csv(results, outpath='', remove_duplicates=True):
+    def study_to_csv(results, outpath='', remove_duplicates=True, sequences=None, drop_invalid=False):
         """
         :param remove_duplicates:
         :param outpath:
-        :param results: bravado.http_future.HttpFuture object
+        :param results: bravado.http_future.HttpFuture object or list of already downloaded mutations
+        :param sequences: optional DataFrame of reference sequences, if given protein changes are validated
+        see validate_protein_changes
+        :param drop_invalid: bool drop mutations that do not match the reference sequences
+        mutations of genes without a reference sequence are kept
         :return: csv in FamAnalysis format
         """
-        mutations = results.result()
+        mutations = results.result() if hasattr(results, 'result') else results
         data = [(m.chr, m.startPosition, m.endPosition, m.referenceAllele, m.variantAllele, m.gene.hugoGeneSymbol,
                  m.proteinChange, m.patientId, m.uniquePatientKey, m.sampleId, m.studyId, m.ncbiBuild)
                 for m in mutations if m.mutationType == MISSENSE_MUTATION]
@@ -151,8 +427,66 @@ class CbioApi:
         #  mutations can repeat in the same patient in the same study if there are multiple samples per patient
         if remove_duplicates:
             df.drop_duplicates(keep='first', inplace=True, ignore_index=True, subset=DUPLICATE_EXCLUSION_COLUMNS)
+        if sequences is not None:
+            df = CbioApi.validate_protein_changes(df, sequences, drop_invalid=drop_invalid)
         if outpath:
-            df.to_csv(outpath)
+            with atomic_write(outpath, 'w') as file:
+                df.to_csv(file)
+        return df
+
+    @staticmethod
+    def _gather(sequences, seq_idx, start, width=1):
+        """
+        gathers substrings of many sequences at once from a single concatenated buffer
+        :param sequences: pandas Series of str
+        :param seq_idx: numpy int array index of sequence per row, -1 for unknown sequence
+        :param start: numpy int array 0-based start per row
+        :param width: int length of substrings
+        :return: numpy str array, empty string where out of range
+        """
+        sequences = sequences.fillna('').astype(str)
+        #  last entry of lengths and offsets is an empty sentinel sequence, unknown rows (-1) point to it
+        lengths = np.append(sequences.str.len().to_numpy(dtype=np.int64), 0)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        #  last byte is a sentinel for rows out of range
+        buffer = np.frombuffer((''.join(sequences) + ' ').encode(), dtype='S1')
+        in_range = (seq_idx >= 0) & (start >= 0) & (start + width <= lengths[seq_idx])
+        first = np.where(in_range, offsets[seq_idx] + start, len(buffer) - 1)
+        idx = first[:, None] + np.where(in_range[:, None], np.arange(width), 0)
+        gathered = np.ascontiguousarray(buffer[idx]).view(f'S{width}').ravel().astype(f'U{width}')
+        return np.where(in_range, gathered, '')
+
+    @staticmethod
+    def validate_protein_changes(df, sequences, drop_invalid=False):
+        """
+        vectorized validation of missense protein changes (e.g. V600E) against reference sequences
+        catches isoform and genome build mismatches between cBio and KEGG
+        :param df: DataFrame in STUDY_COLUMNS format
+        :param sequences: DataFrame indexed by gene symbol with columns aa_seq, na_seq
+        see KeggGene.sequence_table
+        :param drop_invalid: bool if true mismatching rows are dropped
+        rows of genes missing from sequences have HasReference false and are always kept
+        :return: DataFrame with added VALIDATION_COLUMNS
+        """
+        #  protein changes repeat across patients, parse each distinct change once
+        codes, uniques = pd.factorize(df['Variant'], use_na_sentinel=False)
+        changes = pd.Series(uniques, dtype=object).astype(str).str.extract(PROTEIN_CHANGE_RE)
+        position = pd.to_numeric(changes[1], errors='coerce').fillna(0).to_numpy(dtype=np.int64)[codes]
+        ref_aa = changes[0].fillna('').to_numpy(dtype=str)[codes]
+        seq_idx = sequences.index.get_indexer(df['Protein'])
+        #  last entry is for genes missing from sequences (-1)
+        aa_len = np.append(sequences['aa_seq'].fillna('').astype(str).str.len().to_numpy(dtype=np.int64), 0)
+        has_reference = aa_len[seq_idx] > 0
+        seq_aa = CbioApi._gather(sequences['aa_seq'], seq_idx, position - 1)
+        valid = (position > 0) & (seq_aa == ref_aa)
+        codon_start = np.where(valid, CODON_LENGTH * (position - 1), -1)
+        codon = CbioApi._gather(sequences['na_seq'], seq_idx, codon_start, width=CODON_LENGTH)
+        values = {'RefAA': ref_aa, 'AAPosition': position, 'AltAA': changes[2].fillna('').to_numpy(dtype=str)[codes],
+                  'SeqAA': seq_aa, 'Codon': codon, 'CodonStart': codon_start, 'HasReference': has_reference,
+                  'Valid': valid}
+        df = df.assign(**{column: values[column] for column in VALIDATION_COLUMNS})
+        if drop_invalid:
+            df = df[df['Valid'] | ~df['HasReference']].reset_index(drop=True)
         return df
 
     def cancer_types_dict(self):
@@ -182,12 +516,13 @@ class CbioApi:
 class KeggApi:
     """api for kegg"""
 
-    def __init__(self):
+    def __init__(self, pool_size=KEGG_POOL_SIZE):
         """
         constructor for Kegg
+        all instances share a single pooled session, see kegg_session
+        :param pool_size: int number of workers that will query KEGG concurrently
         """
-        self.api = create_session(KEGG_API_URL, retries=RETRIES, wait_time=WAIT_TIME,
-                                  status_forcelist=RETRY_STATUS_LIST)
+        self.api = kegg_session(pool_size)
 
     @staticmethod
     def format_multiple_genes(genes):
@@ -206,9 +541,15 @@ class KeggApi:
         query = command.format(*params)
         if verbose:
             print(command.format(*params))
-        data = safe_get_request(self.api, query)
-        if not data:
+        command_type = command[len(KEGG_API_URL):].split('/')[1]
+        with METRICS.timer('kegg_request_seconds', command=command_type):
+            data = safe_get_request(self.api, query)
+        status = data.status_code if data is not None else 'error'
+        METRICS.inc('kegg_responses_total', command=command_type, status=status)
+        if data is None:
             raise ConnectionError(f'querry: {query} --> Failed')
+        #  bytes read from the socket, i.e. before gzip decoding
+        METRICS.inc('kegg_response_bytes_total', data.raw.tell(), command=command_type)
         if not data.ok:
             raise ConnectionError(f'querry: {query} --> Failed with code {data.status_code}')
         return data.text
@@ -405,6 +746,7 @@ class KeggApi:
                 res[gene_name] += row
         return res
 
+    @METRICS.timed('stage_seconds', stage='parse_genes_info')
     def _process_genes_info(self, data):
         genes_dict = {}
         genes = data.split(GENE_SEPERATOR)[:-1]
@@ -489,16 +831,21 @@ class ESMEmbedding:
 
     Note: class tested on google colab, and worked fine
     """
-    def __init__(self, model_name='esm1b_t33_650M_UR50S'):
+    def __init__(self, model_name=ESM_MODEL, model=None, alphabet=None):
         """
         :param model_name: str esm model name
+        :param model: optional preloaded esm model, used instead of model_name together with alphabet
+        :param alphabet: optional esm alphabet of model
         """
-        self.model, self.alphabet = pretrained.load_model_and_alphabet(model_name)
+        if model is not None:
+            self.model, self.alphabet = model, alphabet
+        else:
+            self.model, self.alphabet = pretrained.load_model_and_alphabet(model_name)
         self.batch_converter = self.alphabet.get_batch_converter()
         self.model.eval()  # set to eval mode
 
         # Precompute index map for standard amino acids
-        aa_order = "ACDEFGHIKLMNPQRSTVWY"
+        aa_order = ESM_AA_ORDER
         tok_to_idx = self.alphabet.tok_to_idx
         self.aa_indices = [tok_to_idx[aa] for aa in aa_order]
         self.aa_order = aa_order
@@ -533,6 +880,22 @@ class ESMEmbedding:
 
         return seq_probs
 
+    def protein_probabilities(self, seq_id, seq, window=ESM_MAX_LEN):
+        """
+        mutation probabilities of a single protein
+        sequences longer than window are embedded in consecutive windows
+        :param seq_id: str sequence id
+        :param seq: str amino acid sequence
+        :param window: int max residues per model call
+        :return: mutation probabilities matrix [L, 20]
+        """
+        probs = []
+        for i, chunk in enumerate(read_in_chunks(seq, window)):
+            with METRICS.timer('stage_seconds', stage='esm_inference'):
+                results, tokens = self.embed_sequences([(f'{seq_id}_{i}', chunk)])
+            probs.extend(self.mutation_probabilities(results, tokens))
+        return np.concatenate(probs) if probs else np.empty((0, len(self.aa_order)), dtype=np.float32)
+
     def get_aa_order(self):
         """
         :return: String of amino acid order used for probability matrix columns